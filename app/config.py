@@ -21,6 +21,15 @@ class Settings(BaseSettings):
     )
     # Có thể trỏ đến thư mục mô hình đã tải sẵn (offline).
     trocr_model_path: Path | None = Field(default=None, env="OCR_TROCR_MODEL_PATH")
+    # torch.compile tăng tốc inference nhưng lần gọi đầu tốn thời gian biên
+    # dịch đáng kể, nên tắt mặc định và chỉ bật cho deployment chạy dài.
+    trocr_compile: bool = Field(default=False, env="OCR_TROCR_COMPILE")
+    # Lượng tử hóa int8 phần decoder TrOCR (cần bitsandbytes và CUDA);
+    # encoder và vocab head giữ nguyên FP16 vì nhạy với lượng tử hóa.
+    trocr_load_in_8bit: bool = Field(default=False, env="OCR_TROCR_LOAD_IN_8BIT")
+    # Chạy một lượt generate mồi khi khởi động để request đầu không phải
+    # trả chi phí chọn thuật toán cuDNN/biên dịch.
+    trocr_warmup: bool = Field(default=True, env="OCR_TROCR_WARMUP")
 
     class Config:
         env_file = ".env"
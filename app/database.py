@@ -3,23 +3,55 @@ from __future__ import annotations
 from contextlib import contextmanager
 from typing import Iterator
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session, declarative_base, sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session, declarative_base, scoped_session, sessionmaker
 
 from .config import settings
 
 
-engine = create_engine(
-    settings.database_url,
-    connect_args={"check_same_thread": False} if settings.database_url.startswith("sqlite") else {},
-)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+if settings.database_url.startswith("sqlite"):
+    # QueuePool mặc định: mỗi thread checkout một kết nối riêng (vẫn được
+    # tái sử dụng giữa các request) nên transaction của các request song song
+    # không giẫm lên nhau. StaticPool dùng chung đúng một kết nối cho mọi
+    # thread — commit/rollback của request này cắt ngang transaction của
+    # request kia — nên chỉ hợp với DB :memory:.
+    engine = create_engine(
+        settings.database_url,
+        connect_args={"check_same_thread": False},
+    )
+else:
+    engine = create_engine(
+        settings.database_url,
+        pool_size=10,
+        max_overflow=20,
+        pool_recycle=3600,
+        pool_pre_ping=True,
+    )
+
+if settings.database_url.startswith("sqlite"):
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragma(dbapi_connection, _connection_record) -> None:
+        # WAL cho phép đọc song song với ghi, synchronous=NORMAL giảm số lần
+        # fsync mỗi commit mà vẫn an toàn khi dùng WAL.
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+# expire_on_commit=False giữ nguyên trạng thái object sau commit nên caller
+# có thể dùng tiếp sau khi session đóng mà không cần expunge/refresh.
+SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
+# scoped_session tái sử dụng session theo thread nên không phải dựng lại
+# identity map cho mỗi lần gọi session_scope trong cùng một request.
+ScopedSession = scoped_session(SessionLocal)
 Base = declarative_base()
 
 
 @contextmanager
 def session_scope() -> Iterator[Session]:
-    session = SessionLocal()
+    session = ScopedSession()
     try:
         yield session
         session.commit()
@@ -27,4 +59,4 @@ def session_scope() -> Iterator[Session]:
         session.rollback()
         raise
     finally:
-        session.close()
+        ScopedSession.remove()
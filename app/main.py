@@ -1,15 +1,31 @@
 from __future__ import annotations
 
-import base64
+import csv
+import os
+import uuid
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, StringIO
 from pathlib import Path
 
+import aiofiles
+import numpy as np
+from jinja2 import Environment, FileSystemLoader
+from jinja2.bccache import FileSystemBytecodeCache
+
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile, Request
-from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    ORJSONResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 
-from sqlalchemy import inspect, text
+from sqlalchemy import select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
 from sqlalchemy.orm import selectinload
 
 from PIL import Image
@@ -18,13 +34,25 @@ from pytesseract import Output
 
 from .config import settings
 from .database import Base, engine, session_scope
-from .models import OCRImage, OCRRun
-from .schemas import OCRResponseSchema, OCRRunSchema
+from .models import OCRImage, OCRRun, OCRTextResult
+from .schemas import OCRResponseSchema, OCRRunSchema, OCRRunSummarySchema
 from .services.ocr_service import OCRService
 
-app = FastAPI(title="OCR Service", version="1.0.0")
+app = FastAPI(title="OCR Service", version="1.0.0", default_response_class=ORJSONResponse)
 
-templates = Jinja2Templates(directory=str(Path(__file__).resolve().parent / "templates"))
+# Biên dịch template một lần cho mỗi worker: tắt auto_reload và lưu bytecode
+# xuống đĩa để các worker sau không phải parse lại template. Cache nằm trong
+# data_dir của app chứ không phải /tmp: bytecode được un-marshal lúc render
+# nên thư mục chứa nó không được để người dùng khác ghi vào.
+_template_cache_dir = settings.data_dir / "jinja_cache"
+_template_cache_dir.mkdir(parents=True, exist_ok=True)
+_jinja_env = Environment(
+    loader=FileSystemLoader(str(Path(__file__).resolve().parent / "templates")),
+    bytecode_cache=FileSystemBytecodeCache(str(_template_cache_dir)),
+    auto_reload=False,
+    autoescape=True,
+)
+templates = Jinja2Templates(env=_jinja_env)
 
 
 def format_confidence(value: float | None) -> str | None:
@@ -41,17 +69,35 @@ def format_confidence(value: float | None) -> str | None:
 templates.env.filters["format_confidence"] = format_confidence
 
 
-def _ensure_language_column() -> None:
-    inspector = inspect(engine)
-    columns = {column["name"] for column in inspector.get_columns("ocr_runs")}
-    if "language" not in columns:
-        with engine.connect() as connection:
-            connection.execute(text("ALTER TABLE ocr_runs ADD COLUMN language VARCHAR(50)"))
-            connection.commit()
+def _apply_schema_migrations() -> None:
+    """Thêm các cột/chỉ mục mới cho database đã tồn tại từ phiên bản cũ.
+
+    Các lệnh ``ALTER TABLE`` được chạy dạng idempotent (bỏ qua lỗi cột đã
+    tồn tại) thay vì reflect toàn bộ schema qua ``inspect()`` mỗi lần worker
+    khởi động.
+    """
+
+    statements = (
+        "ALTER TABLE ocr_runs ADD COLUMN language VARCHAR(50)",
+        "ALTER TABLE ocr_runs ADD COLUMN content_hash VARCHAR(64)",
+        "CREATE INDEX IF NOT EXISTS ix_ocr_runs_content_hash ON ocr_runs (content_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_ocr_runs_created_at ON ocr_runs (created_at)",
+    )
+    with engine.connect() as connection:
+        for statement in statements:
+            try:
+                connection.execute(text(statement))
+            except (OperationalError, ProgrammingError):
+                # Cột đã tồn tại: SQLite báo OperationalError, PostgreSQL báo
+                # ProgrammingError (và không hỗ trợ ADD COLUMN IF NOT EXISTS
+                # trước bản 9.6 nên vẫn phải bắt lỗi thay vì dựa vào cú pháp).
+                connection.rollback()
+            else:
+                connection.commit()
 
 
 Base.metadata.create_all(bind=engine)
-_ensure_language_column()
+_apply_schema_migrations()
 ocr_service = OCRService()
 
 
@@ -59,26 +105,43 @@ def _default_lang_for(engine: str) -> str:
     return ocr_service.default_language_for(engine) or ""
 
 
-def _detach_run(session, run: OCRRun) -> OCRRun:
-    """Detach ORM objects so they can be safely returned/used after the session."""
+# Các engine được đăng ký một lần khi khởi động nên metadata có thể tính sẵn
+# tại import thay vì dựng lại trên mỗi request.
+_ENGINES = ocr_service.list_engines()
+_DEFAULT_LANGS = {engine: _default_lang_for(engine) for engine in _ENGINES}
 
-    for image in run.images:
-        session.expunge(image)
-    for result in run.text_results:
-        session.expunge(result)
-    session.expunge(run)
-    return run
 
+@app.on_event("startup")
+async def _warm_engines() -> None:
+    # Nạp trước model của các engine trong threadpool để request đầu tiên
+    # không phải chịu độ trễ khởi tạo.
+    await run_in_threadpool(ocr_service.warmup)
 
-def _load_runs() -> list[OCRRun]:
+
+def _load_runs(limit: int = 50, offset: int = 0) -> list[OCRRun]:
     with session_scope() as session:
         runs = (
             session.query(OCRRun)
-            .options(selectinload(OCRRun.images), selectinload(OCRRun.text_results))
+            .options(
+                # Danh sách chỉ cần thumbnail (``primary_image`` được joinedload
+                # sẵn từ relationship) và phần tóm tắt kết quả, không hydrate
+                # mọi trang ảnh hay cột ``text`` đầy đủ.
+                selectinload(OCRRun.text_results)
+                .load_only(
+                    OCRTextResult.id,
+                    OCRTextResult.variant_label,
+                    OCRTextResult.confidence,
+                    OCRTextResult.image_id,
+                )
+                .raiseload("*"),
+            )
             .order_by(OCRRun.created_at.desc())
+            .limit(limit)
+            .offset(offset)
             .all()
         )
-        return [_detach_run(session, run) for run in runs]
+        # expire_on_commit=False nên object vẫn dùng được sau khi session đóng.
+        return runs
 
 
 def _load_run(run_id: int) -> OCRRun | None:
@@ -88,28 +151,64 @@ def _load_run(run_id: int) -> OCRRun | None:
             run_id,
             options=(selectinload(OCRRun.images), selectinload(OCRRun.text_results)),
         )
-        if not run:
-            return None
-        return _detach_run(session, run)
+        return run
 
 
 @app.post("/api/v1/ocr", response_model=OCRResponseSchema)
 async def run_ocr(engine: str = "tesseract", file: UploadFile = File(...), lang: str | None = None):
     try:
-        run = ocr_service.process(file=file, engine_name=engine, lang=lang)
+        run = await run_in_threadpool(ocr_service.process, file=file, engine_name=engine, lang=lang)
+    except Exception as exc:  # pragma: no cover - guard rails
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return {"run": run}
+
+
+@app.post("/api/v1/ocr/stream", response_model=OCRResponseSchema)
+async def run_ocr_stream(
+    request: Request,
+    engine: str = "tesseract",
+    lang: str | None = None,
+    filename: str | None = None,
+):
+    """Nhận nội dung tệp trực tiếp từ request body theo từng chunk.
+
+    Khác với ``UploadFile``, dữ liệu được ghi thẳng xuống đĩa nên không bị
+    nhân đôi bộ nhớ với các tài liệu lớn. Tên tệp lấy từ query ``filename``
+    hoặc header ``X-Filename``.
+    """
+
+    name = filename or request.headers.get("x-filename")
+    if not name:
+        raise HTTPException(status_code=400, detail="Missing filename (query or X-Filename header)")
+    # Path(name).name rỗng với các tên như "." hay "dir/": temp_path khi đó
+    # trỏ thẳng vào thư mục chứa, mở ghi sẽ nổ IsADirectoryError thành 500.
+    safe_name = Path(name).name
+    if not safe_name:
+        raise HTTPException(status_code=400, detail=f"Invalid filename: {name!r}")
+    incoming_dir = settings.data_dir / "incoming" / uuid.uuid4().hex
+    incoming_dir.mkdir(parents=True, exist_ok=True)
+    temp_path = incoming_dir / safe_name
+    async with aiofiles.open(temp_path, "wb") as destination:
+        async for chunk in request.stream():
+            await destination.write(chunk)
+    try:
+        run = await run_in_threadpool(ocr_service.process, file=temp_path, engine_name=engine, lang=lang)
     except Exception as exc:  # pragma: no cover - guard rails
         raise HTTPException(status_code=400, detail=str(exc)) from exc
+    finally:
+        temp_path.unlink(missing_ok=True)
+        incoming_dir.rmdir()
     return {"run": run}
 
 
 @app.get("/api/v1/ocr/engines", response_model=list[str])
 async def list_engines():
-    return ocr_service.list_engines()
+    return _ENGINES
 
 
-@app.get("/api/v1/ocr", response_model=list[OCRRunSchema])
-async def list_runs():
-    return _load_runs()
+@app.get("/api/v1/ocr", response_model=list[OCRRunSummarySchema])
+async def list_runs(limit: int = 50, offset: int = 0):
+    return _load_runs(limit=limit, offset=offset)
 
 
 @app.get("/api/v1/ocr/{run_id}", response_model=OCRRunSchema)
@@ -121,12 +220,12 @@ async def get_run(run_id: int):
 
 
 @app.get("/", response_class=HTMLResponse)
-async def home(request: Request):
-    runs = _load_runs()
-    engines = ocr_service.list_engines()
+async def home(request: Request, limit: int = 50, offset: int = 0):
+    runs = await run_in_threadpool(_load_runs, limit=limit, offset=offset)
+    engines = _ENGINES
     selected_engine = "tesseract" if "tesseract" in engines else (engines[0] if engines else "")
-    selected_lang = _default_lang_for(selected_engine) if selected_engine else ""
-    default_langs = {engine: _default_lang_for(engine) for engine in engines}
+    default_langs = _DEFAULT_LANGS
+    selected_lang = default_langs.get(selected_engine, "")
     return templates.TemplateResponse(
         "index.html",
         {
@@ -150,13 +249,13 @@ async def upload_document(
     lang: str | None = Form(None),
     file: UploadFile = File(...),
 ):
-    engines = ocr_service.list_engines()
+    engines = _ENGINES
     try:
-        run = ocr_service.process(file=file, engine_name=engine, lang=lang)
+        run = await run_in_threadpool(ocr_service.process, file=file, engine_name=engine, lang=lang)
     except Exception as exc:  # pragma: no cover - guard rails
-        runs = _load_runs()
-        selected_lang = lang or _default_lang_for(engine)
-        default_langs = {name: _default_lang_for(name) for name in engines}
+        runs = await run_in_threadpool(_load_runs)
+        default_langs = _DEFAULT_LANGS
+        selected_lang = lang or default_langs.get(engine, "")
         return templates.TemplateResponse(
             "index.html",
             {
@@ -181,47 +280,59 @@ async def run_detail(request: Request, run_id: int):
     if not run:
         raise HTTPException(status_code=404, detail="Run not found")
 
-    source_images = sorted((img for img in run.images if img.kind == "source"), key=lambda img: img.sequence)
-
+    # ``run.images`` đã được sắp xếp theo (sequence, label) ngay trong SQL nên
+    # chỉ cần một lượt duyệt để tách ảnh gốc và gom nhóm biến thể.
+    source_images: list[OCRImage] = []
     preprocessed_map: dict[str, list[OCRImage]] = {}
-    for image in (img for img in run.images if img.kind == "preprocessed"):
+    for image in run.images:
+        if image.kind == "source":
+            source_images.append(image)
+            continue
         parts = image.label.split("_")
         base_label = "_".join(parts[:2]) if len(parts) >= 2 else image.label
         preprocessed_map.setdefault(base_label, []).append(image)
 
     preprocessed_groups = []
     for source in source_images:
-        variants = sorted(preprocessed_map.get(source.label, []), key=lambda img: img.sequence)
+        variants = preprocessed_map.pop(source.label, [])
         if variants:
             preprocessed_groups.append({"source": source, "variants": variants})
 
-    remaining_variants = []
-    for label, images in preprocessed_map.items():
-        if all(group["source"] is None or label != group["source"].label for group in preprocessed_groups):
-            remaining_variants.extend(images)
-
+    remaining_variants = [image for images in preprocessed_map.values() for image in images]
     if remaining_variants:
-        preprocessed_groups.append({"source": None, "variants": sorted(remaining_variants, key=lambda img: (img.sequence, img.label))})
+        preprocessed_groups.append({"source": None, "variants": remaining_variants})
     results = sorted(
         run.text_results,
         key=lambda r: (r.confidence if r.confidence is not None else 0.0, len(r.text)),
         reverse=True,
     )
 
-    return templates.TemplateResponse(
-        "run_detail.html",
-        {
-            "request": request,
-            "run": run,
-            "source_images": list(source_images),
-            "preprocessed_groups": preprocessed_groups,
-            "results": results,
-            "now": datetime.utcnow(),
-            "active_page": "dashboard",
-        },
+    # Render theo dạng stream: trình duyệt nhận HTML ngay khi từng khối được
+    # sinh ra thay vì đợi render xong toàn bộ trang với run nhiều biến thể.
+    template = _jinja_env.get_template("run_detail.html")
+    return StreamingResponse(
+        template.stream(
+            {
+                "request": request,
+                "run": run,
+                "source_images": source_images,
+                "preprocessed_groups": preprocessed_groups,
+                "results": results,
+                "now": datetime.utcnow(),
+                "active_page": "dashboard",
+            }
+        ),
+        media_type="text/html",
     )
 
 
+def _confidence_or_nan(value: object) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
 def _render_labeling_template(
     request: Request,
     *,
@@ -298,9 +409,22 @@ async def labeling_detect(request: Request, file: UploadFile = File(...), lang:
     width, height = image.size
     language = (lang.strip() if lang else None) or settings.tess_lang
 
+    # Ghi tệp gốc ra đĩa một lần: Tesseract đọc thẳng đường dẫn (không phải
+    # re-encode ảnh PIL) và trình duyệt tải lại qua endpoint riêng thay vì
+    # nhúng base64 phình ~33% vào HTML.
+    labeling_dir = settings.data_dir / "labeling"
+    labeling_dir.mkdir(parents=True, exist_ok=True)
+    image_uuid = uuid.uuid4().hex
+    suffix = Path(file.filename).suffix if file.filename else ""
+    stored_path = labeling_dir / f"{image_uuid}{suffix or '.png'}"
+    stored_path.write_bytes(raw_bytes)
+
     try:
-        data = pytesseract.image_to_data(image, lang=language, output_type=Output.DICT)
+        raw_tsv = await run_in_threadpool(
+            pytesseract.image_to_data, str(stored_path), lang=language, output_type=Output.BYTES
+        )
     except Exception as exc:  # pragma: no cover - guard rails when OCR backend fails
+        stored_path.unlink(missing_ok=True)
         return _render_labeling_template(
             request,
             image_data=None,
@@ -313,51 +437,74 @@ async def labeling_detect(request: Request, file: UploadFile = File(...), lang:
             status_code=500,
         )
 
+    # Đọc TSV thô một lần bằng csv.reader thay vì để pytesseract dựng 12 list
+    # song song (Output.DICT) rồi phải duyệt lại lần nữa.
+    reader = csv.reader(
+        StringIO(raw_tsv.decode("utf-8", errors="replace")),
+        delimiter="\t",
+        quoting=csv.QUOTE_NONE,
+    )
+    header = next(reader, [])
+    column = {name: position for position, name in enumerate(header)}
+    words_raw: list[str] = []
+    conf_raw: list[str] = []
+    left_raw: list[int] = []
+    top_raw: list[int] = []
+    width_raw: list[int] = []
+    height_raw: list[int] = []
+    if {"text", "conf", "left", "top", "width", "height"} <= column.keys():
+        for row in reader:
+            if len(row) < len(header):
+                continue
+            words_raw.append(row[column["text"]])
+            conf_raw.append(row[column["conf"]])
+            left_raw.append(int(row[column["left"]]))
+            top_raw.append(int(row[column["top"]]))
+            width_raw.append(int(row[column["width"]]))
+            height_raw.append(int(row[column["height"]]))
+
+    # Chuyển các cột sang mảng NumPy: lọc, tính phần trăm và sắp xếp đều là
+    # phép toán vector thay vì hàng nghìn thao tác dict/float thuần Python
+    # với trang nhiều chữ.
     boxes: list[dict[str, object]] = []
-    total = len(data.get("text", []))
-    for index in range(total):
-        word = (data.get("text", [""])[index] or "").strip()
-        if not word:
-            continue
-
-        confidence_value = None
-        confidence_raw = data.get("conf", [None])[index]
-        if confidence_raw not in (None, ""):
-            try:
-                confidence_value = float(confidence_raw)
-            except (TypeError, ValueError):
-                confidence_value = None
-
-        if confidence_value is not None and confidence_value < 0:
-            continue
-
-        left = int(data.get("left", [0])[index] or 0)
-        top = int(data.get("top", [0])[index] or 0)
-        box_width = int(data.get("width", [0])[index] or 0)
-        box_height = int(data.get("height", [0])[index] or 0)
-
-        boxes.append(
-            {
-                "text": word,
-                "confidence": confidence_value,
-                "confidence_display": f"{confidence_value:.1f}" if confidence_value is not None else None,
-                "left": left,
-                "top": top,
-                "width": box_width,
-                "height": box_height,
-                "left_pct": (left / width * 100) if width else 0,
-                "top_pct": (top / height * 100) if height else 0,
-                "width_pct": (box_width / width * 100) if width else 0,
-                "height_pct": (box_height / height * 100) if height else 0,
-            }
+    if words_raw:
+        words = np.array([(word or "").strip() for word in words_raw], dtype=object)
+        conf = np.array([_confidence_or_nan(value) for value in conf_raw], dtype=np.float64)
+        left = np.asarray(left_raw, dtype=np.int64)
+        top = np.asarray(top_raw, dtype=np.int64)
+        box_w = np.asarray(width_raw, dtype=np.int64)
+        box_h = np.asarray(height_raw, dtype=np.int64)
+
+        keep = (words != "") & ~(conf < 0)
+        order = np.lexsort((left[keep], top[keep]))
+        words, conf, left, top, box_w, box_h = (
+            array[keep][order] for array in (words, conf, left, top, box_w, box_h)
         )
 
-    boxes.sort(key=lambda item: (item["top"], item["left"]))
-
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    encoded_image = base64.b64encode(buffer.getvalue()).decode("ascii")
-    image_data = f"data:image/png;base64,{encoded_image}"
+        # Một phép broadcast duy nhất cho cả bốn cột phần trăm.
+        denom = np.array([width, height, width, height], dtype=np.float64)
+        scale = np.divide(100.0, denom, out=np.zeros(4), where=denom > 0)
+        pcts = np.stack([left, top, box_w, box_h], axis=1) * scale
+
+        for index in range(len(words)):
+            confidence_value = None if np.isnan(conf[index]) else float(conf[index])
+            boxes.append(
+                {
+                    "text": words[index],
+                    "confidence": confidence_value,
+                    "confidence_display": f"{confidence_value:.1f}" if confidence_value is not None else None,
+                    "left": int(left[index]),
+                    "top": int(top[index]),
+                    "width": int(box_w[index]),
+                    "height": int(box_h[index]),
+                    "left_pct": float(pcts[index, 0]),
+                    "top_pct": float(pcts[index, 1]),
+                    "width_pct": float(pcts[index, 2]),
+                    "height_pct": float(pcts[index, 3]),
+                }
+            )
+
+    image_data = f"/labeling/img/{image_uuid}"
 
     return _render_labeling_template(
         request,
@@ -370,19 +517,42 @@ async def labeling_detect(request: Request, file: UploadFile = File(...), lang:
     )
 
 
+@app.get("/labeling/img/{image_uuid}")
+async def labeling_image(image_uuid: str):
+    if not image_uuid.isalnum():
+        raise HTTPException(status_code=404, detail="Image not found")
+    stored_path = next((settings.data_dir / "labeling").glob(f"{image_uuid}.*"), None)
+    if stored_path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(
+        stored_path,
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
 @app.get("/runs/{run_id}/images/{image_id}")
-async def get_run_image(run_id: int, image_id: int):
+async def get_run_image(request: Request, run_id: int, image_id: int):
+    # Ảnh của một lần chạy không bao giờ thay đổi sau khi tạo nên ETag chỉ cần
+    # dựa trên cặp id; trình duyệt có thể cache vĩnh viễn và nhận 304 mà không
+    # tốn truy vấn DB hay đọc file.
+    etag = f'"{run_id}-{image_id}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304)
+
     with session_scope() as session:
-        image = (
-            session.query(OCRImage)
-            .filter(OCRImage.run_id == run_id, OCRImage.id == image_id)
-            .one_or_none()
-        )
-        if image is None:
-            raise HTTPException(status_code=404, detail="Image not found")
-        session.expunge(image)
-
-    image_path = Path(image.path)
-    if not image_path.exists():
-        raise HTTPException(status_code=404, detail="Image file missing on server")
-    return FileResponse(image_path)
+        path = session.execute(
+            select(OCRImage.path).where(OCRImage.id == image_id, OCRImage.run_id == run_id)
+        ).scalar_one_or_none()
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    # stat một lần rồi truyền kết quả cho FileResponse để nó không stat lại.
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError as exc:
+        raise HTTPException(status_code=404, detail="Image file missing on server") from exc
+    return FileResponse(
+        path,
+        stat_result=stat_result,
+        headers={"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag},
+    )
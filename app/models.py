@@ -13,16 +13,31 @@ class OCRRun(Base):
     __tablename__ = "ocr_runs"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
-    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
     engine: Mapped[str] = mapped_column(String(50))
     language: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
+    content_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
     original_file_path: Mapped[str] = mapped_column(String)
     converted_file_path: Mapped[Optional[str]] = mapped_column(String, nullable=True)
     summary_text: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     best_confidence: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
 
-    images: Mapped[List["OCRImage"]] = relationship("OCRImage", back_populates="run", cascade="all, delete-orphan")
+    images: Mapped[List["OCRImage"]] = relationship(
+        "OCRImage",
+        back_populates="run",
+        cascade="all, delete-orphan",
+        order_by="(OCRImage.sequence, OCRImage.label)",
+    )
     text_results: Mapped[List["OCRTextResult"]] = relationship("OCRTextResult", back_populates="run", cascade="all, delete-orphan")
+    # Ảnh trang đầu tiên dùng làm thumbnail cho danh sách: quan hệ một-một
+    # nên joinedload rẻ hơn một câu SELECT IN kéo về mọi trang.
+    primary_image: Mapped[Optional["OCRImage"]] = relationship(
+        "OCRImage",
+        primaryjoin="and_(OCRImage.run_id == OCRRun.id, OCRImage.kind == 'source', OCRImage.sequence == 1)",
+        viewonly=True,
+        uselist=False,
+        lazy="joined",
+    )
 
 
 class OCRImage(Base):
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 from datetime import datetime
-from pathlib import Path
 from typing import List, Optional
 
 from pydantic import BaseModel
@@ -9,7 +8,9 @@ from pydantic import BaseModel
 
 class OCRImageSchema(BaseModel):
     id: int
-    path: Path
+    # Các cột đường dẫn được lưu dạng chuỗi; giữ nguyên str để khỏi dựng
+    # đối tượng Path cho từng trường khi serialize.
+    path: str
     kind: str
     label: str
     sequence: int
@@ -34,8 +35,8 @@ class OCRRunSchema(BaseModel):
     created_at: datetime
     engine: str
     language: Optional[str]
-    original_file_path: Path
-    converted_file_path: Optional[Path]
+    original_file_path: str
+    converted_file_path: Optional[str]
     summary_text: Optional[str]
     best_confidence: Optional[float]
     images: List[OCRImageSchema]
@@ -45,6 +46,45 @@ class OCRRunSchema(BaseModel):
         orm_mode = True
 
 
+class OCRImageSummarySchema(BaseModel):
+    id: int
+    kind: str
+    label: str
+    sequence: int
+
+    class Config:
+        orm_mode = True
+
+
+class OCRTextResultSummarySchema(BaseModel):
+    id: int
+    variant_label: str
+    confidence: Optional[float]
+    image_id: Optional[int]
+
+    class Config:
+        orm_mode = True
+
+
+class OCRRunSummarySchema(BaseModel):
+    """Bản rút gọn của ``OCRRunSchema`` cho danh sách: bỏ các cột nặng
+    (``text`` của kết quả, ``path`` của ảnh) để tránh tải dữ liệu không dùng."""
+
+    id: int
+    created_at: datetime
+    engine: str
+    language: Optional[str]
+    original_file_path: str
+    converted_file_path: Optional[str]
+    summary_text: Optional[str]
+    best_confidence: Optional[float]
+    primary_image: Optional[OCRImageSummarySchema]
+    text_results: List[OCRTextResultSummarySchema]
+
+    class Config:
+        orm_mode = True
+
+
 class OCRRequestSchema(BaseModel):
     engine: str = "tesseract"
 
@@ -1,13 +1,21 @@
 from __future__ import annotations
 
+import hashlib
+import os
 import shutil
 import subprocess
 from pathlib import Path
 from typing import List
 
+import cv2
 from pdf2image import convert_from_path
 from PIL import Image
 
+try:  # PyMuPDF render PDF trong tiến trình, không fork Poppler cho từng lần gọi.
+    import fitz
+except ImportError:  # pragma: no cover - phụ thuộc tùy chọn
+    fitz = None
+
 from ..config import settings
 
 SUPPORTED_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".tiff", ".bmp"}
@@ -15,13 +23,38 @@ SUPPORTED_DOCUMENT_EXTENSIONS = {".pdf", ".doc", ".docx"}
 
 
 def save_upload_file(uploaded_file, destination: Path) -> Path:
-    uploaded_file.file.seek(0)
+    source = uploaded_file.file
+    source.seek(0)
+    # SpooledTemporaryFile chỉ tràn xuống đĩa với upload lớn; khi đó dùng
+    # os.sendfile để kernel tự copy, không kéo dữ liệu qua buffer Python.
+    # Không gọi ``fileno()`` khi spool còn trong RAM vì việc đó ép nó ghi đĩa.
+    rolled = getattr(source, "_rolled", False)
     with destination.open("wb") as buffer:
-        shutil.copyfileobj(uploaded_file.file, buffer)
+        if rolled and hasattr(os, "sendfile"):
+            src_fd = source.fileno()
+            size = os.fstat(src_fd).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(buffer.fileno(), src_fd, offset, size - offset)
+                if sent == 0:  # pragma: no cover - defensive
+                    break
+                offset += sent
+        else:
+            shutil.copyfileobj(source, buffer, length=1 << 20)
     uploaded_file.file.close()
     return destination
 
 
+def hash_file(path: Path) -> str:
+    """Băm nội dung tệp theo từng khối để tránh nạp toàn bộ vào bộ nhớ."""
+
+    digest = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def ensure_pdf(path: Path, output_dir: Path) -> Path:
     suffix = path.suffix.lower()
     if suffix == ".pdf":
@@ -45,15 +78,39 @@ def ensure_pdf(path: Path, output_dir: Path) -> Path:
 
 def pdf_to_images(pdf_path: Path, output_dir: Path) -> List[Path]:
     output_dir.mkdir(parents=True, exist_ok=True)
-    images = convert_from_path(str(pdf_path), dpi=settings.pdf_dpi)
-    paths: List[Path] = []
-    for index, image in enumerate(images, start=1):
-        path = output_dir / f"page_{index:03d}.png"
-        image.save(path, format="PNG")
-        paths.append(path)
-    return paths
+    if fitz is not None:
+        # get_pixmap render thẳng trong tiến trình và ghi PNG bằng C,
+        # nhanh hơn nhiều so với đường vòng subprocess + PPM của Poppler.
+        zoom = settings.pdf_dpi / 72
+        matrix = fitz.Matrix(zoom, zoom)
+        page_paths: List[Path] = []
+        with fitz.open(str(pdf_path)) as document:
+            for number, page in enumerate(document, start=1):
+                pixmap = page.get_pixmap(matrix=matrix)
+                page_path = output_dir / f"page-{number:04d}.png"
+                pixmap.save(str(page_path))
+                page_paths.append(page_path)
+        return page_paths
+    # Poppler render các trang song song và tự ghi PNG xuống output_folder,
+    # không cần decode về PIL rồi encode lại trong Python.
+    paths = convert_from_path(
+        str(pdf_path),
+        dpi=settings.pdf_dpi,
+        output_folder=str(output_dir),
+        output_file="page",
+        fmt="png",
+        paths_only=True,
+        thread_count=os.cpu_count() or 1,
+        use_pdftocairo=True,
+    )
+    return [Path(path) for path in sorted(paths)]
 
 
 def load_image(path: Path) -> Image.Image:
-    with Image.open(path) as img:
-        return img.convert("RGB")
+    # OpenCV decode với SIMD và đa luồng, nhanh hơn hẳn Pillow trên ảnh scan
+    # lớn; chỉ rơi về Pillow với định dạng cv2 không đọc được.
+    array = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if array is None:
+        with Image.open(path) as img:
+            return img.convert("RGB")
+    return Image.fromarray(cv2.cvtColor(array, cv2.COLOR_BGR2RGB))
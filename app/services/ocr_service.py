@@ -1,10 +1,19 @@
 from __future__ import annotations
 
+import functools
+import logging
+import os
+import queue
+import shutil
+import threading
 import uuid
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
 from fastapi import UploadFile
+from sqlalchemy import func
 from sqlalchemy.orm import selectinload
 from PIL import Image
 
@@ -15,16 +24,92 @@ from .file_processing import (
     SUPPORTED_DOCUMENT_EXTENSIONS,
     SUPPORTED_IMAGE_EXTENSIONS,
     ensure_pdf,
+    hash_file,
     load_image,
     pdf_to_images,
     save_upload_file,
 )
-from .ocr_base import OCREngine
+from .ocr_base import OCREngine, OcrOutput
 from .paddle_engine import PaddleOCREngine
 from .preprocess import ImagePreprocessor
 from .tesseract_engine import TesseractEngine
 from .trocr_engine import TrOCREngine
 
+
+_worker_pool: ProcessPoolExecutor | None = None
+
+
+def _init_ocr_worker() -> None:
+    # Giới hạn Tesseract/OpenMP ở một luồng trong mỗi worker để N tiến trình
+    # không tranh nhau core.
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def _get_worker_pool() -> ProcessPoolExecutor:
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1,
+            initializer=_init_ocr_worker,
+        )
+    return _worker_pool
+
+
+logger = logging.getLogger(__name__)
+
+
+_png_pool: ThreadPoolExecutor | None = None
+
+# Engine dùng chung toàn tiến trình theo (tên, ngôn ngữ): model lớn chỉ nạp
+# một lần thay vì dựng engine mới cho mỗi request.
+_shared_engines: Dict[Tuple[str, Optional[str]], OCREngine] = {}
+_shared_engines_lock = threading.Lock()
+
+
+def _get_png_pool() -> ThreadPoolExecutor:
+    global _png_pool
+    if _png_pool is None:
+        _png_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="png-writer")
+    return _png_pool
+
+
+# Cache engine theo (tên, ngôn ngữ) trong từng tiến trình con: worker sống
+# qua nhiều task nên không phải dựng lại engine (hay nạp lại model) mỗi ảnh.
+_worker_engines: Dict[Tuple[str, Optional[str]], OCREngine] = {}
+
+
+def _ocr_worker(engine_name: str, lang: Optional[str], image_path: str) -> OcrOutput:
+    """Chạy OCR một biến thể trong tiến trình con, nhận đường dẫn thay vì ảnh."""
+
+    key = (engine_name, lang)
+    engine = _worker_engines.get(key)
+    if engine is None:
+        engine = OCRService().get_engine(engine_name, lang=lang)
+        _worker_engines[key] = engine
+    if getattr(engine, "accepts_paths", False):
+        return engine.run(image_path)
+    return engine.run(load_image(Path(image_path)))
+
+
+def _ocr_worker_batch(
+    engine_name: str, lang: Optional[str], image_paths: List[str]
+) -> List[OcrOutput]:
+    """Chạy OCR một lô biến thể trong tiến trình con.
+
+    Một lần ``run_batch`` cho cả lô để chi phí khởi tạo engine chỉ trả một
+    lần mỗi lô thay vì mỗi ảnh.
+    """
+
+    key = (engine_name, lang)
+    engine = _worker_engines.get(key)
+    if engine is None:
+        engine = OCRService().get_engine(engine_name, lang=lang)
+        _worker_engines[key] = engine
+    if hasattr(engine, "run_batch"):
+        return engine.run_batch([Path(path) for path in image_paths])
+    return [_ocr_worker(engine_name, lang, path) for path in image_paths]
+
+
 class OCRService:
     def __init__(self) -> None:
         self.preprocessor = ImagePreprocessor()
@@ -34,7 +119,9 @@ class OCRService:
             "trocr": lambda _=None: TrOCREngine(),
         }
 
+    @functools.lru_cache(maxsize=None)
     def list_engines(self) -> List[str]:
+        # Danh sách engine cố định sau khi khởi tạo nên memoize được.
         return list(self._engine_factories.keys())
 
     def get_engine(self, name: str, *, lang: Optional[str] = None) -> OCREngine:
@@ -42,11 +129,33 @@ class OCRService:
             factory = self._engine_factories[name]
         except KeyError as exc:  # pragma: no cover - guard rails
             raise ValueError(f"Unsupported OCR engine: {name}") from exc
-        engine = factory(lang)
+        key = (name, lang)
+        with _shared_engines_lock:
+            engine = _shared_engines.get(key)
+            if engine is None:
+                engine = factory(lang)
+                _shared_engines[key] = engine
         if lang is not None and hasattr(engine, "set_language"):
             engine.set_language(lang)
         return engine
 
+    def warmup(self) -> None:
+        """Dựng sẵn engine với ngôn ngữ mặc định lúc khởi động app.
+
+        Model lớn (Paddle, TrOCR) được nạp một lần tại đây thay vì bắt
+        request đầu tiên gánh độ trễ khởi tạo.
+        """
+
+        for name in self.list_engines():
+            try:
+                engine = self.get_engine(name, lang=self.default_language_for(name))
+                warm = getattr(engine, "warmup", None)
+                if callable(warm):
+                    warm()
+            except Exception as exc:  # pragma: no cover - warmup không được chặn app
+                logger.warning("Bỏ qua warmup engine %s: %s", name, exc)
+
+    @functools.lru_cache(maxsize=None)
     def default_language_for(self, name: str) -> Optional[str]:
         if name == "tesseract":
             return settings.tess_lang
@@ -56,28 +165,41 @@ class OCRService:
             return None
         return None
 
-    def process(self, file: UploadFile, engine_name: str, *, lang: Optional[str] = None) -> OCRRun:
+    def process(self, file: UploadFile | Path, engine_name: str, *, lang: Optional[str] = None) -> OCRRun:
         resolved_lang = (lang.strip() if lang else None) or self.default_language_for(engine_name)
         engine = self.get_engine(engine_name, lang=resolved_lang)
         run_dir = settings.data_dir / uuid.uuid4().hex
         original_dir = run_dir / "original"
         original_dir.mkdir(parents=True, exist_ok=True)
-        original_path = original_dir / file.filename
-        save_upload_file(file, original_path)
+        if isinstance(file, Path):
+            # Tệp đã được ghi sẵn trên đĩa (endpoint streaming): chỉ cần dời
+            # vào thư mục của lần chạy, không sao chép lại dữ liệu.
+            original_path = original_dir / file.name
+            file.rename(original_path)
+        else:
+            original_path = original_dir / file.filename
+            save_upload_file(file, original_path)
+
+        content_hash = hash_file(original_path)
+        cached_run = self._find_cached_run(content_hash, engine.name, resolved_lang)
+        if cached_run is not None:
+            # Tài liệu giống hệt đã được xử lý trước đó với cùng engine và
+            # ngôn ngữ: trả lại kết quả cũ thay vì chạy OCR lần nữa.
+            shutil.rmtree(run_dir, ignore_errors=True)
+            return cached_run
 
         run = OCRRun(
             engine=engine.name,
             original_file_path=str(original_path),
             language=resolved_lang,
+            content_hash=content_hash,
         )
 
-        images: List[Tuple[Path, Image.Image]] = []
         converted_pdf_path: Path | None = None
 
         suffix = original_path.suffix.lower()
         if suffix in SUPPORTED_IMAGE_EXTENSIONS:
-            image = load_image(original_path)
-            images.append((original_path, image))
+            image_paths = [original_path]
         elif suffix in SUPPORTED_DOCUMENT_EXTENSIONS:
             converted_dir = run_dir / "converted"
             converted_dir.mkdir(parents=True, exist_ok=True)
@@ -86,88 +208,238 @@ class OCRService:
             else:
                 converted_pdf_path = ensure_pdf(original_path, converted_dir)
             run.converted_file_path = str(converted_pdf_path)
-            images_paths = pdf_to_images(converted_pdf_path, run_dir / "pages")
-            for path in images_paths:
-                images.append((path, load_image(path)))
+            image_paths = pdf_to_images(converted_pdf_path, run_dir / "pages")
         else:
             raise ValueError(f"Unsupported file type: {suffix}")
 
+        preferred_variants = self._preferred_variants(engine)
+        png_futures: List[Future] = []
+
+        def _produce(out: "queue.Queue") -> None:
+            """Stage rasterize/preprocess/ghi đĩa, chạy trên thread riêng.
+
+            Decode từng trang ngay trước khi dùng (peak memory một trang) và
+            đẩy kết quả qua queue có giới hạn để stage OCR/DB phía sau chạy
+            song song mà không tích tụ quá nhiều trang trong RAM.
+            """
+
+            try:
+                for index, image_path in enumerate(image_paths, start=1):
+                    image = load_image(image_path)
+                    page_label = f"page_{index}"
+                    variants = self.preprocessor.generate(
+                        image,
+                        allowed_labels=preferred_variants,
+                    )
+                    items = []
+                    for order, (label, variant_array) in enumerate(variants):
+                        # Preprocessor trả ndarray; chỉ dựng PIL một lần tại
+                        # đây cho bước save và cho engine.
+                        variant_image = Image.fromarray(variant_array)
+                        variant_path = run_dir / "preprocessed" / f"{page_label}_{label}.png"
+                        variant_path.parent.mkdir(parents=True, exist_ok=True)
+                        # TIFF không nén ghi gần như memcpy và Tesseract đọc
+                        # được trực tiếp; bản PNG cho giao diện được encode
+                        # nền vì deflate là bước tốn CPU nhất của mỗi biến thể.
+                        ocr_path = variant_path.with_suffix(".tif")
+                        variant_image.save(ocr_path, format="TIFF")
+                        # compress_level=1: biến thể chỉ là tệp trung gian, đổi
+                        # vài phần trăm dung lượng lấy deflate nhanh hơn nhiều.
+                        png_futures.append(
+                            _get_png_pool().submit(
+                                variant_image.save, variant_path, format="PNG", compress_level=1
+                            )
+                        )
+                        items.append((order, label, variant_path, variant_array, ocr_path))
+                    # Trang gốc không cần nữa sau khi đã sinh biến thể.
+                    image.close()
+                    out.put((index, page_label, image_path, items))
+                out.put(None)
+            except BaseException as exc:  # pragma: no cover - chuyển lỗi về thread chính
+                out.put(exc)
+
         with session_scope() as session:
             session.add(run)
             session.flush()
 
-            for index, (image_path, image) in enumerate(images, start=1):
-                db_image = OCRImage(
-                    run_id=run.id,
-                    path=str(image_path),
-                    kind="source",
-                    label=f"page_{index}",
-                    sequence=index,
-                )
-                session.add(db_image)
-                session.flush()
-
-                preferred_variants = None
-                if hasattr(engine, "preferred_variants"):
-                    preferred_callable = getattr(engine, "preferred_variants")
-                    if callable(preferred_callable):
-                        preferred_variants = preferred_callable()
-                    else:
-                        preferred_variants = preferred_callable  # pragma: no cover - defensive
-                variants = self.preprocessor.generate(
-                    image,
-                    allowed_labels=preferred_variants,
+            produced: "queue.Queue" = queue.Queue(maxsize=4)
+            producer = threading.Thread(target=_produce, args=(produced,), daemon=True)
+            producer.start()
+
+            # Engine không có run_batch và không chạy được qua process pool
+            # (Paddle giữ model trong tiến trình) thì OCR ngay từng biến thể,
+            # chồng lấp với stage trước.
+            inline_ocr = not hasattr(engine, "run_batch") and not getattr(
+                engine, "parallel_safe", False
+            )
+            # Chỉ giữ ndarray đến cuối tài liệu khi engine thật sự tiêu thụ
+            # mảng ở _run_engine (TrOCR nhận batch ảnh); các engine đọc từ
+            # đường dẫn mà vẫn pin mảng sẽ giữ mọi biến thể của cả tài liệu
+            # trong RAM một cách vô ích.
+            keep_arrays = getattr(engine, "batch_accepts_images", False)
+            results: List[OcrOutput] = []
+            pending: List[Tuple[OCRImage, Path, Optional[np.ndarray]]] = []
+            db_images: List[OCRImage] = []
+            while True:
+                produced_item = produced.get()
+                if produced_item is None:
+                    break
+                if isinstance(produced_item, BaseException):
+                    raise produced_item
+                index, page_label, image_path, items = produced_item
+                db_images.append(
+                    OCRImage(
+                        run_id=run.id,
+                        path=str(image_path),
+                        kind="source",
+                        label=page_label,
+                        sequence=index,
+                    )
                 )
-                for order, (label, variant_image) in enumerate(variants):
-                    variant_path = run_dir / "preprocessed" / f"{db_image.label}_{label}.png"
-                    variant_path.parent.mkdir(parents=True, exist_ok=True)
-                    variant_image.save(variant_path, format="PNG")
+                for order, label, variant_path, variant_array, ocr_path in items:
                     db_variant_image = OCRImage(
                         run_id=run.id,
                         path=str(variant_path),
                         kind="preprocessed",
-                        label=f"{db_image.label}_{label}",
+                        label=f"{page_label}_{label}",
                         sequence=order,
                     )
-                    session.add(db_variant_image)
-                    session.flush()
+                    db_images.append(db_variant_image)
+                    pending.append(
+                        (db_variant_image, ocr_path, variant_array if keep_arrays else None)
+                    )
+                    if inline_ocr:
+                        # Engine inline nhận thẳng mảng tại đây, không cần giữ
+                        # lại sau vòng lặp.
+                        results.append(engine.run(variant_array))
+            producer.join()
+
+            # Một lần flush gán id cho toàn bộ ảnh thay vì một round-trip
+            # cho mỗi bản ghi.
+            session.add_all(db_images)
+            session.flush()
 
-                    result = engine.run(variant_image)
-                    text_result = OCRTextResult(
+            if not inline_ocr:
+                results = self._run_engine(engine, pending)
+            session.add_all(
+                [
+                    OCRTextResult(
                         run_id=run.id,
                         image_id=db_variant_image.id,
                         variant_label=db_variant_image.label,
                         text=result.text,
                         confidence=result.confidence,
                     )
-                    session.add(text_result)
+                    for (db_variant_image, _, _), result in zip(pending, results)
+                ]
+            )
+
+            # Các tệp TIFF trung gian chỉ phục vụ OCR, không cần giữ lại.
+            for _, ocr_path, _ in pending:
+                ocr_path.unlink(missing_ok=True)
+
+            # Chặn commit tới khi các bản PNG nền ghi xong: bản ghi DB chỉ
+            # được xuất hiện khi tệp nó trỏ tới đã thực sự nằm trên đĩa.
+            # result() nổi lỗi encode lên để transaction rollback thay vì
+            # commit bản ghi trỏ tới tệp chưa từng được ghi.
+            for png_future in png_futures:
+                png_future.result()
 
             session.flush()
-            best = self._select_best_result(run)
+            best = self._select_best_result(session, run)
             if best:
                 run.summary_text = best.text
                 run.best_confidence = best.confidence
-            session.add(run)
-            session.commit()
-            refreshed_run = (
+            # Nạp các collection ngay bây giờ; nhờ expire_on_commit=False,
+            # run vẫn dùng được sau khi session đóng mà không cần query
+            # refresh hay expunge từng object.
+            _ = run.images
+            _ = run.text_results
+        return run
+
+    @staticmethod
+    def _preferred_variants(engine: OCREngine) -> Optional[Iterable[str]]:
+        """Danh sách biến thể engine muốn nhận, nếu engine có khai báo."""
+
+        preferred = getattr(engine, "preferred_variants", None)
+        if preferred is None:
+            return None
+        if callable(preferred):
+            return preferred()
+        return preferred  # pragma: no cover - defensive
+
+    def _run_engine(
+        self,
+        engine: OCREngine,
+        pending: List[Tuple[OCRImage, Path, Optional[np.ndarray]]],
+    ) -> List[OcrOutput]:
+        """OCR các biến thể đã lưu, song song hóa khi engine cho phép.
+
+        Engine gọn nhẹ như Tesseract (mỗi lần chạy là một subprocess độc lập)
+        khai báo ``parallel_safe`` để được chia ra ``ProcessPoolExecutor``;
+        các engine giữ model lớn trong bộ nhớ chạy tuần tự trong tiến trình
+        hiện tại.
+        """
+
+        if getattr(engine, "parallel_safe", False) and len(pending) > 1:
+            # Chia loạt biến thể thành lô cho ProcessPoolExecutor: mỗi worker
+            # (đã ghim OMP_THREAD_LIMIT=1) chạy run_batch trên lô của mình
+            # nên vừa song song hóa giữa các worker vừa chỉ trả chi phí khởi
+            # tạo một lần mỗi lô.
+            pool = _get_worker_pool()
+            lang = getattr(engine, "lang", None)
+            paths = [str(path) for _, path, _ in pending]
+            workers = os.cpu_count() or 1
+            chunk_size = -(-len(paths) // workers)
+            futures = [
+                pool.submit(_ocr_worker_batch, engine.name, lang, paths[start : start + chunk_size])
+                for start in range(0, len(paths), chunk_size)
+            ]
+            return [output for future in futures for output in future.result()]
+        if hasattr(engine, "run_batch") and len(pending) > 1:
+            # Một lần gọi cho cả loạt biến thể: chi phí khởi tạo engine chỉ
+            # phải trả một lần thay vì mỗi ảnh.
+            if getattr(engine, "batch_accepts_images", False):
+                return engine.run_batch([array for _, _, array in pending])
+            return engine.run_batch([path for _, path, _ in pending])
+        if getattr(engine, "accepts_paths", False):
+            # Biến thể đã nằm trên đĩa: đưa đường dẫn cho engine thay vì bắt
+            # nó encode lại ảnh PIL.
+            return [engine.run(path) for _, path, _ in pending]
+        # Mảng chỉ được giữ cho engine nhận batch ảnh; nếu rơi vào nhánh này
+        # mà không có mảng thì đọc lại từ tệp TIFF trung gian (vẫn còn trên
+        # đĩa tới sau _run_engine).
+        return [
+            engine.run(array if array is not None else load_image(path))
+            for _, path, array in pending
+        ]
+
+    def _find_cached_run(
+        self, content_hash: str, engine_name: str, lang: Optional[str]
+    ) -> OCRRun | None:
+        with session_scope() as session:
+            run = (
                 session.query(OCRRun)
                 .options(selectinload(OCRRun.images), selectinload(OCRRun.text_results))
-                .get(run.id)
+                .filter(
+                    OCRRun.content_hash == content_hash,
+                    OCRRun.engine == engine_name,
+                    OCRRun.language == lang,
+                )
+                .order_by(OCRRun.created_at.desc())
+                .first()
             )
-            if refreshed_run is not None:
-                for image in refreshed_run.images:
-                    session.expunge(image)
-                for result in refreshed_run.text_results:
-                    session.expunge(result)
-                session.expunge(refreshed_run)
-        return refreshed_run
-
-    def _select_best_result(self, run: OCRRun) -> OCRTextResult | None:
-        if not run.text_results:
-            return None
-        sorted_results = sorted(
-            run.text_results,
-            key=lambda r: (r.confidence if r.confidence is not None else 0.0, len(r.text)),
-            reverse=True,
+            return run
+
+    def _select_best_result(self, session, run: OCRRun) -> OCRTextResult | None:
+        """Để DB chọn bản ghi tốt nhất thay vì sort toàn bộ kết quả ở Python."""
+
+        return (
+            session.query(OCRTextResult)
+            .filter(OCRTextResult.run_id == run.id)
+            .order_by(
+                OCRTextResult.confidence.desc().nullslast(),
+                func.length(OCRTextResult.text).desc(),
+            )
+            .first()
         )
-        return sorted_results[0]
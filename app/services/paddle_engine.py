@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import functools
 import logging
-import statistics
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
+import cv2
 import numpy as np
 from paddleocr import PaddleOCR
 from PIL import Image
@@ -28,6 +30,54 @@ logger = logging.getLogger(__name__)
 # Đường dẫn tới từ điển tiếng Việt mở rộng cho PaddleOCR.
 
 
+def _as_rgb_ndarray(image: Image.Image | np.ndarray) -> np.ndarray:
+    """Đưa ảnh về ndarray RGB mà không copy thừa.
+
+    Preprocessor đã làm việc trên ndarray nên nhận thẳng mảng đó, tránh
+    round-trip ``Image.fromarray`` + ``np.array`` (hai lần memcpy cả ảnh).
+    """
+
+    if isinstance(image, np.ndarray):
+        if image.ndim == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        return image
+    return np.array(image.convert("RGB"))
+
+
+@functools.lru_cache(maxsize=1)
+def _validated_vi_dict_path(mtime: float) -> Optional[str]:
+    """Đọc và kiểm tra từ điển tiếng Việt, memo theo mtime của tệp.
+
+    Mỗi lần đổi ngôn ngữ ``_ensure_ocr`` lại hỏi đường dẫn từ điển; khóa
+    cache bằng mtime để chỉ đọc lại khi tệp thực sự thay đổi.
+    """
+
+    try:
+        with PADDLE_VI_DICT_PATH.open("r", encoding="utf-8") as handle:
+            # ``splitlines`` preserves the leading space entry that Paddle expects.
+            entries = handle.read().splitlines()
+    except OSError as exc:  # pragma: no cover - defensive guard
+        logger.warning("Unable to read Paddle dictionary %s: %s", PADDLE_VI_DICT_PATH, exc)
+        return None
+    if len(entries) > MAX_CUSTOM_DICT_CHARS:
+        logger.warning(
+            "Ignoring custom Paddle dictionary %s: contains %d entries but the Latin "
+            "recognition model only supports %d.",
+            PADDLE_VI_DICT_PATH,
+            len(entries),
+            MAX_CUSTOM_DICT_CHARS,
+        )
+        return None
+    return str(PADDLE_VI_DICT_PATH)
+
+
+# Một model PaddleOCR ấm cho mỗi (lang, dict) dùng chung toàn tiến trình:
+# det + rec + angle-cls nạp từ đĩa khá đắt, không nên trả lại chi phí đó
+# mỗi lần đổi ngôn ngữ qua lại hay mỗi instance engine.
+_shared_ocr: Dict[Tuple[str, Optional[str]], PaddleOCR] = {}
+_shared_ocr_lock = threading.Lock()
+
+
 class PaddleOCREngine:
     name = "paddle"
 
@@ -35,37 +85,38 @@ class PaddleOCREngine:
         initial = (lang or settings.paddle_lang).strip()
         self.lang = initial or settings.paddle_lang
         self._ocr: PaddleOCR | None = None
+        # Predictor của Paddle không thread-safe; engine lại được dùng chung
+        # toàn tiến trình nên mọi lời gọi ocr() phải đi qua khóa này.
+        self._infer_lock = threading.Lock()
 
     def _ensure_ocr(self) -> PaddleOCR:
         if self._ocr is None:
-            ocr_kwargs = {"use_angle_cls": True, "lang": self.lang, "show_log": False}
-            if self.lang.lower().startswith("vi"):
-                dict_path = self._resolve_custom_dict()
-                if dict_path is not None:
-                    ocr_kwargs["rec_char_dict_path"] = dict_path
-            self._ocr = PaddleOCR(**ocr_kwargs)
+            dict_path = (
+                self._resolve_custom_dict() if self.lang.lower().startswith("vi") else None
+            )
+            key = (self.lang, dict_path)
+            with _shared_ocr_lock:
+                ocr = _shared_ocr.get(key)
+                if ocr is None:
+                    ocr_kwargs = {"use_angle_cls": True, "lang": self.lang, "show_log": False}
+                    if dict_path is not None:
+                        ocr_kwargs["rec_char_dict_path"] = dict_path
+                    ocr = PaddleOCR(**ocr_kwargs)
+                    _shared_ocr[key] = ocr
+            self._ocr = ocr
         return self._ocr
 
     def _resolve_custom_dict(self) -> Optional[str]:
-        if not PADDLE_VI_DICT_PATH.exists():
-            return None
         try:
-            with PADDLE_VI_DICT_PATH.open("r", encoding="utf-8") as handle:
-                # ``splitlines`` preserves the leading space entry that Paddle expects.
-                entries = handle.read().splitlines()
-        except OSError as exc:  # pragma: no cover - defensive guard
-            logger.warning("Unable to read Paddle dictionary %s: %s", PADDLE_VI_DICT_PATH, exc)
-            return None
-        if len(entries) > MAX_CUSTOM_DICT_CHARS:
-            logger.warning(
-                "Ignoring custom Paddle dictionary %s: contains %d entries but the Latin "
-                "recognition model only supports %d.",
-                PADDLE_VI_DICT_PATH,
-                len(entries),
-                MAX_CUSTOM_DICT_CHARS,
-            )
+            mtime = PADDLE_VI_DICT_PATH.stat().st_mtime
+        except OSError:
             return None
-        return str(PADDLE_VI_DICT_PATH)
+        return _validated_vi_dict_path(mtime)
+
+    def warmup(self) -> None:
+        """Nạp model det/rec/cls một lần lúc khởi động thay vì ở request đầu."""
+
+        self._ensure_ocr()
 
     def set_language(self, lang: Optional[str]) -> None:
         candidate = (lang or settings.paddle_lang).strip()
@@ -87,17 +138,25 @@ class PaddleOCREngine:
 
         return ("original", "grayscale", "contrast")
 
-    def run(self, image: Image.Image) -> OcrOutput:
-        np_image = np.array(image.convert("RGB"))
+    def run(self, image: Image.Image | np.ndarray) -> OcrOutput:
+        # Mỗi biến thể một lần ``ocr()``: PaddleOCR coi danh sách ảnh là các
+        # trang PDF đã rasterize sẵn, và với det bật, phiên bản đang ghim
+        # (2.7.0.3) từ chối kiểu list bằng ``exit(0)`` — không gom batch được.
+        np_image = _as_rgb_ndarray(image)
         ocr = self._ensure_ocr()
-        results = ocr.ocr(np_image, cls=True)
+        with self._infer_lock:
+            results = ocr.ocr(np_image, cls=True)
+        return self._aggregate_pages(results)
+
+    @staticmethod
+    def _aggregate_pages(results) -> OcrOutput:
         texts = []
         confidences = []
         for res in results:
-            for line in res:
+            for line in res or []:
                 text, confidence = line[1][0], float(line[1][1])
                 texts.append(text)
                 confidences.append(confidence)
         aggregated_text = "\n".join(texts)
-        confidence = statistics.mean(confidences) if confidences else None
+        confidence = float(np.mean(confidences)) if confidences else None
         return OcrOutput(text=aggregated_text.strip(), confidence=confidence)
@@ -2,11 +2,18 @@ from __future__ import annotations
 
 from typing import Iterable, List, Optional, Set, Tuple
 
-from PIL import Image, ImageFilter, ImageOps
+import cv2
+import numpy as np
+from PIL import Image
 
 
 class ImagePreprocessor:
-    """Apply a simple but effective preprocessing pipeline."""
+    """Apply a simple but effective preprocessing pipeline.
+
+    Toàn bộ các bước chạy trên ``numpy.ndarray`` với OpenCV: các vòng lặp C
+    có SIMD thay cho callback Python từng pixel (``Image.point``) vốn là nút
+    thắt lớn nhất của bước tiền xử lý.
+    """
 
     def __init__(self) -> None:
         self.steps = (
@@ -19,47 +26,69 @@ class ImagePreprocessor:
 
     def generate(
         self,
-        image: Image.Image,
+        image: Image.Image | np.ndarray,
         *,
         allowed_labels: Optional[Iterable[str]] = None,
-    ) -> List[Tuple[str, Image.Image]]:
-        """Return the available image variants.
+    ) -> List[Tuple[str, np.ndarray]]:
+        """Return the available image variants as NumPy arrays.
 
         Some OCR engines hoạt động tốt hơn khi bỏ qua các bước xử lý ảnh
         nhất định. Để hỗ trợ điều này, cho phép truyền vào ``allowed_labels``
         nhằm giới hạn các biến thể trả về mà vẫn duy trì chuỗi xử lý cho các
         bước tiếp theo.
+
+        Ảnh đầu vào chỉ được chuyển sang ndarray một lần; bên gọi tự dựng
+        ``Image.fromarray`` khi cần đối tượng PIL (ví dụ để ``save``).
         """
 
-        outputs: List[Tuple[str, Image.Image]] = []
-        current = image
+        if isinstance(image, np.ndarray):
+            source = image
+        else:
+            source = np.asarray(image.convert("RGB"))
+        outputs: List[Tuple[str, np.ndarray]] = []
+        current = source
         allowed: Optional[Set[str]] = set(allowed_labels) if allowed_labels is not None else None
+        remaining: Set[str] = set(allowed) if allowed is not None else set()
         for label, fn in self.steps:
-            base_image = image if label == "original" else current
-            next_image = fn(base_image)
+            if allowed is not None and not remaining:
+                # Đã đủ các biến thể được yêu cầu: dừng sớm, không chạy nốt
+                # các bước tốn bộ nhớ phía sau (median/threshold) chỉ để vứt đi.
+                break
+            base_array = source if label == "original" else current
+            next_array = fn(base_array)
             if allowed is None or label in allowed:
-                outputs.append((label, next_image))
-            current = next_image
+                outputs.append((label, next_array))
+                remaining.discard(label)
+            current = next_array
         return outputs
 
     @staticmethod
-    def _identity(image: Image.Image) -> Image.Image:
-        return image.copy()
+    def _identity(array: np.ndarray) -> np.ndarray:
+        # Không copy: không bước nào phía sau ghi đè lên mảng nguồn, và bản
+        # copy từng nhân đôi peak memory của mỗi trang một cách vô ích.
+        return array
 
     @staticmethod
-    def _to_grayscale(image: Image.Image) -> Image.Image:
-        return ImageOps.grayscale(image)
+    def _to_grayscale(array: np.ndarray) -> np.ndarray:
+        if array.ndim == 2:
+            return array
+        return cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
 
     @staticmethod
-    def _enhance_contrast(image: Image.Image) -> Image.Image:
-        return ImageOps.autocontrast(image)
+    def _enhance_contrast(array: np.ndarray) -> np.ndarray:
+        # Kéo giãn histogram về [0, 255], tương đương ImageOps.autocontrast
+        # với cutoff=0 trên ảnh xám.
+        return cv2.normalize(array, None, 0, 255, cv2.NORM_MINMAX)
 
     @staticmethod
-    def _median_filter(image: Image.Image) -> Image.Image:
-        return image.filter(ImageFilter.MedianFilter(size=3))
+    def _median_filter(array: np.ndarray) -> np.ndarray:
+        return cv2.medianBlur(array, 3)
 
     @staticmethod
-    def _threshold(image: Image.Image) -> Image.Image:
-        if image.mode != "L":
-            image = ImageOps.grayscale(image)
-        return image.point(lambda p: 255 if p > 160 else 0, mode="1").convert("L")
+    def _threshold(array: np.ndarray) -> np.ndarray:
+        # Chuỗi bước luôn chạy grayscale trước median/threshold (kể cả khi
+        # allowed_labels bỏ qua các nhãn trung gian), nên đầu vào chắc chắn
+        # đã là ảnh xám — không cần chuyển đổi phòng hờ tốn một lượt cả ảnh.
+        assert array.ndim == 2, "threshold nhận ảnh xám từ bước trước"
+        _, binary = cv2.threshold(array, 160, 255, cv2.THRESH_BINARY)
+        return binary
@@ -1,30 +1,158 @@
 from __future__ import annotations
 
-import statistics
-from typing import Optional
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import pytesseract
 from pytesseract import Output
 from PIL import Image
 
+try:  # tesserocr giữ Tesseract thường trú, tránh spawn subprocess mỗi ảnh.
+    import tesserocr
+except ImportError:  # pragma: no cover - phụ thuộc tùy chọn
+    tesserocr = None
+
 from ..config import settings
 from .ocr_base import OCREngine, OcrOutput
 
 
 class TesseractEngine:
     name = "tesseract"
+    # Mỗi lần chạy là một subprocess độc lập, không giữ model trong bộ nhớ
+    # nên an toàn để phân tán qua ProcessPoolExecutor.
+    parallel_safe = True
+    # ``run`` nhận được cả đường dẫn tệp, không bắt buộc PIL Image.
+    accepts_paths = True
 
     def __init__(self, lang: Optional[str] = None) -> None:
         initial = (lang or settings.tess_lang).strip()
         self.lang = initial or settings.tess_lang
+        self._api = None
+        # PyTessBaseAPI giữ trạng thái qua chuỗi SetImage/GetUTF8Text/
+        # MeanTextConf; engine dùng chung toàn tiến trình nên phải khóa
+        # trọn chuỗi đó lại.
+        self._api_lock = threading.Lock()
 
     def set_language(self, lang: Optional[str]) -> None:
         candidate = (lang or settings.tess_lang).strip()
-        self.lang = candidate or settings.tess_lang
+        new_lang = candidate or settings.tess_lang
+        if new_lang != self.lang:
+            self.lang = new_lang
+            # API thường trú gắn với ngôn ngữ cũ, khởi tạo lại ở lần chạy sau.
+            self._api = None
+
+    def _ensure_api(self):
+        """Trả về PyTessBaseAPI thường trú nếu tesserocr khả dụng."""
+
+        if tesserocr is None:
+            return None
+        if self._api is None:
+            with self._api_lock:
+                if self._api is None:
+                    self._api = tesserocr.PyTessBaseAPI(lang=self.lang)
+        return self._api
+
+    def preferred_variants(self) -> tuple[str, ...]:
+        """Tesseract hưởng lợi từ đủ cả chuỗi biến thể, kể cả nhị phân hóa."""
+
+        return ("original", "grayscale", "contrast", "median_filter", "threshold")
+
+    def warmup(self) -> None:
+        """Nạp sẵn API thường trú (nếu tesserocr khả dụng) lúc khởi động."""
+
+        self._ensure_api()
+
+    def run(self, image: Image.Image | str | Path) -> OcrOutput:
+        api = self._ensure_api()
+        if api is not None:
+            # API thường trú: không spawn subprocess và không nạp lại model
+            # ngôn ngữ cho từng ảnh.
+            with self._api_lock:
+                if isinstance(image, (str, Path)):
+                    api.SetImageFile(str(image))
+                else:
+                    api.SetImage(image)
+                text = api.GetUTF8Text()
+                mean_conf = api.MeanTextConf()
+            confidence = float(mean_conf) if mean_conf >= 0 else None
+            return OcrOutput(text=text.strip(), confidence=confidence)
 
-    def run(self, image: Image.Image) -> OcrOutput:
-        text = pytesseract.image_to_string(image, lang=self.lang)
-        data = pytesseract.image_to_data(image, lang=self.lang, output_type=Output.DICT)
-        confidences = [float(conf) for conf in data.get("conf", []) if conf not in {"-1", "-1.0"}]
-        confidence = statistics.mean(confidences) if confidences else None
+        # Với ảnh đã nằm trên đĩa, truyền thẳng đường dẫn để pytesseract khỏi
+        # re-encode PIL Image thành PNG tạm trước khi Tesseract mở lại.
+        # Một lần image_to_data cho cả văn bản lẫn độ tin cậy: trước đây
+        # image_to_string + image_to_data là hai lượt OCR đầy đủ trên cùng ảnh.
+        source = str(image) if isinstance(image, (str, Path)) else image
+        data = pytesseract.image_to_data(source, lang=self.lang, output_type=Output.DICT)
+        page_texts, page_confidences = self._group_pages(data)
+        text = "\n".join(page_texts.get(1, []))
+        confidences = page_confidences.get(1, [])
+        confidence = float(np.mean(confidences)) if confidences else None
         return OcrOutput(text=text.strip(), confidence=confidence)
+
+    @staticmethod
+    def _group_pages(data: dict) -> Tuple[Dict[int, List[str]], Dict[int, List[float]]]:
+        """Một lần quét TSV: dựng lại văn bản theo dòng và gom conf theo trang.
+
+        Từ được nối bằng khoảng trắng trong cùng một ``(block, par, line)``,
+        các dòng nối bằng xuống dòng — tương đương đầu ra của
+        ``image_to_string`` (không giữ dòng trống giữa các đoạn).
+        """
+
+        texts: Dict[int, List[str]] = {}
+        confidences: Dict[int, List[float]] = {}
+        current_key = None
+        for page, block, par, line, word, conf in zip(
+            data.get("page_num", []),
+            data.get("block_num", []),
+            data.get("par_num", []),
+            data.get("line_num", []),
+            data.get("text", []),
+            data.get("conf", []),
+        ):
+            page_index = int(page)
+            if conf not in {"-1", "-1.0"}:
+                confidences.setdefault(page_index, []).append(float(conf))
+            if not word.strip():
+                continue
+            key = (page_index, block, par, line)
+            page_lines = texts.setdefault(page_index, [])
+            if key != current_key or not page_lines:
+                page_lines.append(word)
+            else:
+                page_lines[-1] += " " + word
+            current_key = key
+        return texts, confidences
+
+    def run_batch(self, paths: List[Path]) -> List[OcrOutput]:
+        """OCR nhiều ảnh trong một lần gọi Tesseract.
+
+        Tesseract chấp nhận một tệp văn bản liệt kê đường dẫn ảnh và xử lý
+        tất cả trong cùng một tiến trình, tránh trả chi phí khởi tạo (nạp
+        model ngôn ngữ) cho từng biến thể. Một lần ``image_to_data`` cho cả
+        loạt; văn bản lẫn độ tin cậy dựng lại theo cột ``page_num`` của TSV.
+        """
+
+        if not paths:
+            return []
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".txt", delete=False, encoding="utf-8"
+        ) as handle:
+            handle.write("\n".join(str(path) for path in paths))
+            list_path = handle.name
+        try:
+            data = pytesseract.image_to_data(list_path, lang=self.lang, output_type=Output.DICT)
+        finally:
+            os.unlink(list_path)
+
+        page_texts, page_confidences = self._group_pages(data)
+        outputs: List[OcrOutput] = []
+        for index in range(len(paths)):
+            text = "\n".join(page_texts.get(index + 1, []))
+            confidences = page_confidences.get(index + 1, [])
+            confidence = float(np.mean(confidences)) if confidences else None
+            outputs.append(OcrOutput(text=text.strip(), confidence=confidence))
+        return outputs
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
+import contextlib
 import logging
+import os
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 from PIL import Image
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
 
@@ -19,6 +24,9 @@ class TrOCREngine:
     """OCR engine sử dụng mô hình ``microsoft/trocr`` từ Hugging Face."""
 
     name = "trocr"
+    # run_batch nhận thẳng ảnh (ndarray/PIL) thay vì đường dẫn: model giữ
+    # trong tiến trình này nên không cần ghi/đọc lại đĩa như engine khác.
+    batch_accepts_images = True
 
     def __init__(
         self,
@@ -27,6 +35,12 @@ class TrOCREngine:
         model_path: Optional[Path | str] = None,
         generation_kwargs: Optional[dict] = None,
     ) -> None:
+        # Đặt trước khi chạm vào CUDA: expandable_segments gộp các cấp phát
+        # nhỏ thay đổi kích thước theo từng generate, tránh phân mảnh VRAM
+        # trên service chạy dài. setdefault để vận hành vẫn override được.
+        os.environ.setdefault(
+            "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:128"
+        )
         self.model_name = (model_name or settings.trocr_model_name).strip() or settings.trocr_model_name
         self.device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
         resolved_path = model_path if model_path is not None else settings.trocr_model_path
@@ -41,11 +55,28 @@ class TrOCREngine:
             self.model_path = None
         self._processor: TrOCRProcessor | None = None
         self._model: VisionEncoderDecoderModel | None = None
+        # Chặn các request đầu tiên chạy song song cùng nạp model hai lần.
+        self._init_lock = threading.Lock()
+        # Cache (processor, model) theo tên model để việc đổi qua lại bằng
+        # set_model không phải parse lại trọng số; bản bị thay được đưa về
+        # CPU thay vì vứt bỏ.
+        self._component_cache: dict[str, tuple[TrOCRProcessor, VisionEncoderDecoderModel]] = {}
+        # (height, width, mean, std) đọc một lần từ image_processor cho
+        # đường tiền xử lý trên GPU.
+        self._pp_params: tuple | None = None
+        # Stream riêng cho copy/tiền xử lý: H2D của batch kế tiếp chồng lấp
+        # được với vòng decode đang chạy trên stream mặc định.
+        self._copy_stream = (
+            torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+        )
         defaults = {
             "max_new_tokens": 128,
             "num_beams": 4,
             "early_stopping": True,
             "no_repeat_ngram_size": 2,
+            # KV-cache tránh tính lại self-attention O(T^2) của decoder;
+            # ghi tường minh để không phụ thuộc mặc định của config model.
+            "use_cache": True,
         }
         if generation_kwargs:
             defaults.update(generation_kwargs)
@@ -56,7 +87,33 @@ class TrOCREngine:
 
         return ("original", "grayscale", "contrast")
 
+    def _component_key(self) -> str:
+        return str(self.model_path) if self.model_path is not None else self.model_name
+
     def _ensure_components(self) -> tuple[TrOCRProcessor, VisionEncoderDecoderModel]:
+        # Double-checked locking: đường nóng trả về không cần khóa; chỉ lần
+        # nạp đầu (hoặc ngay sau set_model) mới phải tranh chấp, tránh hai
+        # request đồng thời cùng nạp model tốn đôi RAM lẫn thời gian.
+        if self._processor is not None and self._model is not None:
+            return self._processor, self._model
+        with self._init_lock:
+            if self._processor is not None and self._model is not None:
+                return self._processor, self._model
+            return self._load_components()
+
+    def _load_components(self) -> tuple[TrOCRProcessor, VisionEncoderDecoderModel]:
+        key = self._component_key()
+        cached = self._component_cache.get(key)
+        if cached is not None:
+            # LRU: đưa entry vừa dùng xuống cuối và kéo model về device
+            # (có thể đang đậu ở CPU sau một lần set_model).
+            self._component_cache[key] = self._component_cache.pop(key)
+            self._processor, self._model = cached
+            if not getattr(self._model, "is_loaded_in_8bit", False):
+                # Model 8-bit không bao giờ rời GPU (bitsandbytes cấm .to());
+                # chỉ bản FP16/FP32 mới có thể đang đậu ở CPU sau set_model.
+                self._model.to(self.device)
+            return self._processor, self._model
         if self._processor is None:
             try:
                 self._processor = self._load_processor()
@@ -77,9 +134,43 @@ class TrOCREngine:
                     exc,
                 )
                 raise self._translate_os_error(exc) from exc
-            self._model = model.to(self.device)
+            if getattr(model, "is_loaded_in_8bit", False):
+                # bitsandbytes đã đặt model lên GPU và cấm .to()/.half().
+                self._model = model
+            else:
+                self._model = model.to(self.device)
+                if self.device.type == "cuda":
+                    # FP16 giảm một nửa băng thông bộ nhớ và kích hoạt tensor
+                    # core; autocast lúc generate lo phần ép kiểu đầu vào.
+                    self._model = self._model.half()
             self._model.eval()
+            # Tham số chỉ đọc: tắt hẳn bookkeeping autograd trên từng tensor
+            # trọng số thay vì chỉ dựa vào inference_mode lúc generate.
+            self._model.requires_grad_(False)
+            self._model.config.use_cache = True
             self._ensure_generation_tokens()
+            if settings.trocr_compile:
+                # Chỉ compile encoder: ViT luôn thấy đúng một shape đầu vào
+                # cố định nên ăn trọn fullgraph tĩnh, còn decoder đổi độ dài
+                # theo từng bước sinh sẽ bị re-compile liên tục. Bật qua cấu
+                # hình vì lần gọi đầu phải trả chi phí biên dịch.
+                try:
+                    self._model.encoder = torch.compile(
+                        self._model.encoder,
+                        mode="reduce-overhead",
+                        fullgraph=True,
+                        dynamic=False,
+                    )
+                except Exception as exc:  # pragma: no cover - torch cũ
+                    logger.warning("Không thể compile encoder TrOCR: %s", exc)
+            self._component_cache[key] = (self._processor, self._model)
+            if len(self._component_cache) > 2:
+                oldest = next(iter(self._component_cache))
+                _, evicted = self._component_cache.pop(oldest)
+                if not getattr(evicted, "is_loaded_in_8bit", False):
+                    # .to() bị bitsandbytes cấm trên model 8-bit; entry đã rời
+                    # cache nên cứ để GC giải phóng thẳng VRAM.
+                    evicted.to("cpu")
         return self._processor, self._model
 
     def _describe_source(self) -> str:
@@ -108,9 +199,32 @@ class TrOCREngine:
         return TrOCRProcessor.from_pretrained(self.model_name)
 
     def _load_model(self) -> VisionEncoderDecoderModel:
-        if self.model_path is not None:
-            return VisionEncoderDecoderModel.from_pretrained(str(self.model_path))
-        return VisionEncoderDecoderModel.from_pretrained(self.model_name)
+        source = str(self.model_path) if self.model_path is not None else self.model_name
+        load_kwargs = {
+            # low_cpu_mem_usage nạp trọng số qua mmap/meta-device: không dựng
+            # bản FP32 đầy đủ trong RAM rồi mới copy sang model.
+            "low_cpu_mem_usage": True,
+            # Nạp thẳng ở dtype đích, khỏi tốn một lượt cast + copy sau đó.
+            "torch_dtype": torch.float16 if self.device.type == "cuda" else torch.float32,
+        }
+        if settings.trocr_load_in_8bit and self.device.type == "cuda":
+            try:
+                from transformers import BitsAndBytesConfig
+
+                load_kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_8bit=True,
+                    # Encoder ViT và vocab head hồi quy mạnh khi int8 hóa;
+                    # chỉ các lớp decoder còn lại được lượng tử hóa.
+                    llm_int8_skip_modules=["encoder", "output_projection", "lm_head"],
+                )
+            except ImportError:  # pragma: no cover - bitsandbytes tùy chọn
+                logger.warning("bitsandbytes không khả dụng, giữ trọng số FP16.")
+        try:
+            return VisionEncoderDecoderModel.from_pretrained(source, **load_kwargs)
+        except (ImportError, TypeError, ValueError) as exc:
+            # Thiếu accelerate hoặc transformers đời cũ: dùng đường nạp thường.
+            logger.debug("Nạp TrOCR kiểu mmap thất bại (%s), dùng from_pretrained mặc định.", exc)
+            return VisionEncoderDecoderModel.from_pretrained(source)
 
     def _ensure_generation_tokens(self) -> None:
         """Bổ sung các mã đặc biệt cần thiết cho quá trình sinh chuỗi."""
@@ -141,43 +255,191 @@ class TrOCREngine:
         if eos_token_id is not None and getattr(self._model.config, "eos_token_id", None) is None:
             self._model.config.eos_token_id = eos_token_id
 
+    def warmup(self) -> None:
+        """Nạp model và chạy một lượt generate mồi lúc khởi động.
+
+        Lượt mồi trả trước chi phí chọn thuật toán cuDNN, upload trọng số
+        và (nếu bật) biên dịch encoder, để request đầu tiên nhanh ngang các
+        request sau.
+        """
+
+        processor, model = self._ensure_components()
+        if not settings.trocr_warmup:
+            return
+        height, width, _, _ = self._preprocess_params(processor)
+        dummy = torch.zeros(
+            (1, 3, height, width),
+            device=self.device,
+            dtype=next(model.parameters()).dtype,
+        )
+        with torch.inference_mode():
+            model.generate(dummy, max_new_tokens=4, use_cache=True)
+
     def set_model(self, model_name: Optional[str]) -> None:
         candidate = (model_name or settings.trocr_model_name).strip()
         new_name = candidate or settings.trocr_model_name
         if new_name == self.model_name and self._model is not None and self._processor is not None:
             return
+        old_key = self._component_key()
         self.model_name = new_name
+        if self._model is not None and self.device.type == "cuda":
+            if getattr(self._model, "is_loaded_in_8bit", False):
+                # Model 8-bit không đậu ở CPU được (bitsandbytes cấm .to());
+                # bỏ hẳn khỏi cache để VRAM được giải phóng.
+                self._component_cache.pop(old_key, None)
+            else:
+                # Nhường VRAM cho model mới; bản cũ vẫn nằm trong cache trên CPU.
+                self._model.to("cpu")
+            torch.cuda.empty_cache()
         self._processor = None
         self._model = None
+        self._pp_params = None
 
-    def run(self, image: Image.Image) -> OcrOutput:
+    @staticmethod
+    def _as_rgb(image: Image.Image | np.ndarray) -> Image.Image | np.ndarray:
+        if isinstance(image, np.ndarray):
+            # Processor của transformers nhận thẳng ndarray RGB; chỉ cần nhân
+            # kênh cho ảnh xám thay vì dựng lại đối tượng PIL.
+            return image if image.ndim == 3 else np.stack((image,) * 3, axis=-1)
+        # convert("RGB") luôn cấp phát ảnh mới kể cả khi mode đã đúng.
+        return image if image.mode == "RGB" else image.convert("RGB")
+
+    def run(
+        self, image: Image.Image | np.ndarray, *, need_confidence: bool = True
+    ) -> OcrOutput:
+        return self.run_batch([image], need_confidence=need_confidence)[0]
+
+    def _preprocess_params(self, processor: TrOCRProcessor) -> tuple:
+        if self._pp_params is None:
+            image_processor = processor.image_processor
+            size = image_processor.size
+            if isinstance(size, dict):
+                height = int(size.get("height", 384))
+                width = int(size.get("width", height))
+            else:  # pragma: no cover - processor đời cũ trả int
+                height = width = int(size)
+            mean = torch.tensor(image_processor.image_mean, device=self.device).view(1, 3, 1, 1)
+            std = torch.tensor(image_processor.image_std, device=self.device).view(1, 3, 1, 1)
+            self._pp_params = (height, width, mean, std)
+        return self._pp_params
+
+    def _gpu_preprocess(self, images: List[Image.Image | np.ndarray]) -> torch.Tensor:
+        """Resize + chuẩn hóa cả batch bằng kernel GPU.
+
+        Processor của transformers chạy PIL→numpy→normalize từng ảnh trên
+        CPU; chuyển ảnh uint8 lên device rồi interpolate/normalize một lượt
+        giúp CPU không còn là nút thắt giữ GPU chờ.
+        """
+
+        height, width, mean, std = self._preprocess_params(self._processor)
+        tensors = []
+        for image in images:
+            array = self._as_rgb(image)
+            if not isinstance(array, np.ndarray):
+                array = np.asarray(array)
+            # Staging qua bộ nhớ pinned: copy H2D chạy async thực sự thay vì
+            # chặn stream trên bộ nhớ pageable. Allocator của torch cache các
+            # block pinned nên không trả chi phí cấp phát mỗi lần.
+            tensor = (
+                torch.from_numpy(np.ascontiguousarray(array))
+                .pin_memory()
+                .to(self.device, non_blocking=True)
+            )
+            tensor = tensor.permute(2, 0, 1).unsqueeze(0).float()
+            tensors.append(
+                F.interpolate(tensor, size=(height, width), mode="bilinear", antialias=True)
+            )
+        return torch.cat(tensors, dim=0).div_(255.0).sub_(mean).div_(std)
+
+    def run_batch(
+        self,
+        images: List[Image.Image | np.ndarray],
+        *,
+        need_confidence: bool = True,
+    ) -> List[OcrOutput]:
+        """Nhận diện cả loạt biến thể trong một lần ``generate``.
+
+        Stack ``pixel_values`` theo chiều batch giúp trả chi phí khởi động
+        kernel, cấp phát KV-cache và overhead Python một lần cho cả loạt
+        thay vì từng ảnh batch=1. Khi bên gọi không cần độ tin cậy, đặt
+        ``need_confidence=False`` để generate khỏi materialize một tensor
+        (B, V) điểm số cho mỗi token sinh ra.
+        """
+
+        if not images:
+            return []
         processor, model = self._ensure_components()
-        pixel_values = processor(images=image.convert("RGB"), return_tensors="pt").pixel_values.to(self.device)
+        if self.device.type == "cuda":
+            with torch.cuda.stream(self._copy_stream):
+                pixel_values = self._gpu_preprocess(images)
+            # Stream mặc định (nơi generate chạy) phải đợi copy hoàn tất.
+            torch.cuda.current_stream().wait_stream(self._copy_stream)
+        else:
+            pixel_values = processor(
+                images=[self._as_rgb(image) for image in images],
+                return_tensors="pt",
+            ).pixel_values.to(self.device, non_blocking=True)
         generation_options = dict(self._generation_kwargs)
-        generation_options.update(
-            {
-                "output_scores": True,
-                "return_dict_in_generate": True,
-            }
+        if need_confidence:
+            generation_options.update(
+                {
+                    "output_scores": True,
+                    "return_dict_in_generate": True,
+                }
+            )
+        # inference_mode bỏ hẳn bookkeeping autograd (nhẹ hơn no_grad);
+        # autocast trên CUDA chạy các phép toán ở FP16.
+        autocast = (
+            torch.autocast("cuda", dtype=torch.float16)
+            if self.device.type == "cuda"
+            else contextlib.nullcontext()
         )
-        with torch.no_grad():
+        with torch.inference_mode(), autocast:
             generated = model.generate(pixel_values, **generation_options)
-        sequence = generated.sequences[0]
-        text = processor.batch_decode(sequence.unsqueeze(0), skip_special_tokens=True)[0].strip()
-        confidence = None
+        if need_confidence:
+            sequences = generated.sequences
+            confidences = self._sequence_confidences(generated, len(images))
+        else:
+            sequences = generated
+            confidences = [None] * len(images)
+        texts = processor.batch_decode(sequences, skip_special_tokens=True)
+        return [
+            OcrOutput(text=text.strip(), confidence=confidence)
+            for text, confidence in zip(texts, confidences)
+        ]
+
+    def _sequence_confidences(self, generated, batch_size: int) -> List[Optional[float]]:
+        """Độ tin cậy trung bình theo từng ảnh trong batch."""
+
         if getattr(generated, "sequences_scores", None) is not None:
-            confidence = float(generated.sequences_scores[0].exp().item())
+            # Một lần .tolist() đồng bộ GPU→CPU cho cả batch thay vì mỗi phần tử.
+            return [float(score) for score in generated.sequences_scores.exp().tolist()]
+        scores = generated.scores
+        if not scores:
+            return [None] * batch_size
+        pad_token_id = self._model.generation_config.pad_token_id if self._model else None
+        # Logprob của token được chọn tính thẳng bằng -cross_entropy: kernel
+        # fused đọc mỗi hàng một scalar thay vì ghi trọn phân phối softmax
+        # (V≈50k phần tử) ra bộ nhớ cho từng bước. Ép float32 vì logits FP16
+        # dễ tràn số khi chuẩn hóa.
+        scores_t = torch.stack(scores, dim=0).float()  # (T, B, V)
+        steps, batch, vocab = scores_t.shape
+        tokens = (
+            generated.sequences[:, 1 : steps + 1].transpose(0, 1)  # bỏ token BOS
+        )  # (T, B)
+        token_probs = (
+            -F.cross_entropy(
+                scores_t.reshape(-1, vocab), tokens.reshape(-1), reduction="none"
+            )
+        ).view(steps, batch).exp()  # (T, B)
+        if pad_token_id is not None:
+            mask = tokens != pad_token_id
         else:
-            scores = generated.scores
-            if scores:
-                probabilities = []
-                for step_scores, token_id in zip(scores, sequence[1:]):  # bỏ token BOS
-                    probs = step_scores.softmax(dim=-1)
-                    token_index = int(token_id)
-                    if probs.dim() == 2:
-                        probabilities.append(probs[0, token_index].item())
-                    else:
-                        probabilities.append(probs[token_index].item())
-                if probabilities:
-                    confidence = float(sum(probabilities) / len(probabilities))
-        return OcrOutput(text=text, confidence=confidence)
+            mask = torch.ones_like(token_probs, dtype=torch.bool)
+        counts = mask.sum(dim=0)
+        means = (token_probs * mask).sum(dim=0) / counts.clamp(min=1)
+        # Một lần .tolist() đồng bộ device→CPU cho cả batch.
+        return [
+            float(mean) if count else None
+            for mean, count in zip(means.tolist(), counts.tolist())
+        ]